@@ -48,7 +48,7 @@ def get_audio(dataset: PyhaDFDataset, n_clips: int, cfg):
     """ Returns an array of audio waveforms and an array of one-hot labels """
     return [(
         get_annotation(
-            dataset.samples,
+            dataset.arrays,
             np.random.randint(len(dataset)),
             dataset.class_to_idx,cfg)[0])
             for _ in range(n_clips)]
@@ -72,12 +72,13 @@ def get_augs(dataset: PyhaDFDataset, cfg) -> Tuple[List[Callable],List[str]]:
         BackgroundNoise(cfg) : "Background Noise"})
 
     #Mixup
-    mixup = Mixup(df = dataset.samples,
-                  class_to_idx = dataset.class_to_idx,
-                  cfg = cfg)
+    # Mixup mixes clips within a batch, so batch each clip with other clips
+    mixup = Mixup(cfg)
+    other_clips = get_audio(dataset, cfg.mixup_num_clips_range[1], cfg)
     num_classes = dataset.num_classes
     augmentations.update({
-        lambda x: mixup(x, torch.zeros(num_classes).to(x.device))[0]
+        lambda x: mixup(torch.stack([x, *other_clips]),
+                        torch.zeros(len(other_clips) + 1, num_classes))[0][0]
         : "Mixup"})
 
     return list(augmentations.keys()), list(augmentations.values())
@@ -2,13 +2,13 @@
 File containing data augmentations implemented as torch.nn.Module
 Each augmentation is initialized with only a Config object
 """
+import functools
 import logging
 import os
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Tuple, Iterable
+from typing import Any, Callable, List, Tuple, Iterable
 
 import numpy as np
-import pandas as pd
 import torch
 import torchaudio
 
@@ -62,23 +62,16 @@ def gen_uniform_values(n: int, min_value=0.05) -> List[float] :
 
 class Mixup(torch.nn.Module):
     """
+    Mixes clips of a batch with other clips of the same batch
     Attributes:
-        dataset: Dataset from which to mixup with other clips
-        alpha_range: Range of alpha parameter, which determines 
-        proportion of new audio in augmented clip
-        p: Probability of mixing
+        prob: Probability of mixing each clip
+        ceil_interval: Rounding interval of the mixed targets
+        min_alpha: Smallest proportion of any clip in a mixed clip
+        num_clips_distribution: Distribution of how many other clips to mix in
     """
-    def __init__(
-            self, 
-            df: pd.DataFrame, 
-            class_to_idx: Dict[str, Any],
-            cfg: config.Config
-            ):
+    def __init__(self, cfg: config.Config):
         super().__init__()
-        self.df = df
-        self.class_to_idx = class_to_idx
         self.prob = cfg.mixup_p
-        self.cfg = cfg
         self.ceil_interval = cfg.mixup_ceil_interval
         self.min_alpha = cfg.mixup_min_alpha
 
@@ -88,65 +81,66 @@ class Mixup(torch.nn.Module):
                 cfg.mixup_num_clips_range[1] + 1))
         self.num_clips_distribution = hyperbolic(possible_num_clips)
 
-    def get_rand_clip(self) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
-        """
-        Get random clip from self.df
-        """
-        idx = utils.randint(0, len(self.df))
-        try:
-            clip, target = utils.get_annotation(
-                    df = self.df,
-                    index = idx, 
-                    conf = self.cfg,
-                    class_to_idx = self.class_to_idx)
-            return clip, target
-        except RuntimeError:
-            logger.error('Error loading other clip, ommitted from mixup')
-            return None
-
-    def mix_clips(self, 
-                  clip: torch.Tensor, 
-                  target: torch.Tensor, 
-                  other_annotations: List[Tuple[torch.Tensor, torch.Tensor]]
-        ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """
-        Mixup clips and targets of clip, target, other_annotations
-        """
-        annotations = other_annotations + [(clip, target)]
-        clips, targets = zip(*annotations)
-        mix_factors = gen_uniform_values(len(annotations), min_value = self.min_alpha)
-
-        mixed_clip = sum(c * f for c, f in zip(clips, mix_factors))
-        mixed_target = sum(t * f for t, f in zip(targets, mix_factors))
-        assert isinstance(mixed_target, torch.Tensor)
-        assert isinstance(mixed_clip, torch.Tensor)
-        assert mixed_clip.shape == clip.shape
-        assert mixed_target.shape == target.shape
-        mixed_target = utils.ceil(mixed_target, interval = self.ceil_interval)
-        return mixed_clip, mixed_target
-
     def forward(
             self,
-            clip: torch.Tensor,
-            target: torch.Tensor
+            clips: torch.Tensor,
+            targets: torch.Tensor
         ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Args:
-            clip: Tensor of audio data
-            target: Tensor representing label
+            clips: Tensor of a batch of audio data
+            targets: Tensor of a batch of labels
 
-        Returns: Tensor of audio data mixed with another randomly
-        chosen clip, Tensor of target mixed with the
-        target of the randomly chosen file
+        Returns: Tensor of audio data where each clip is, with probability
+        prob, mixed with other randomly chosen clips of the batch,
+        Tensor of targets mixed the same way
         """
-        if utils.rand(0,1) < self.prob:
-            return clip, target
-
-        num_other_clips = sample(self.num_clips_distribution)
-        other_annotations = [self.get_rand_clip() for _ in range(num_other_clips)]
-        other_annotations = list(filter(None, other_annotations))
-        return self.mix_clips(clip, target, other_annotations)
+        batch_size = clips.shape[0]
+        mixed = torch.rand(batch_size, device=clips.device) < self.prob
+        # A clip can only be mixed with other clips
+        if batch_size < 2 or not mixed.any():
+            return clips, targets
+
+        # Each clip mixes in its own number of other clips
+        # Column 0 is the proportion of the original clip, unused columns are zero
+        num_other_clips = [sample(self.num_clips_distribution) for _ in range(batch_size)]
+        max_other_clips = max(num_other_clips)
+        mix_factors = torch.tensor(
+            [gen_uniform_values(n + 1, min_value = self.min_alpha) + [0.] * (max_other_clips - n)
+             for n in num_other_clips],
+            dtype=clips.dtype, device=clips.device)
+
+        mixed_clips = clips * mix_factors[:, :1]
+        mixed_targets = targets * mix_factors[:, :1]
+        for i in range(1, max_other_clips + 1):
+            # Pair each clip with the next one in a random cycle, so no clip is mixed with itself
+            cycle = torch.randperm(batch_size, device=clips.device)
+            other = torch.empty_like(cycle)
+            other[cycle] = cycle.roll(1)
+            mixed_clips += clips[other] * mix_factors[:, i:i+1]
+            mixed_targets += targets[other] * mix_factors[:, i:i+1]
+        mixed_targets = utils.ceil(mixed_targets, interval = self.ceil_interval)
+
+        return (torch.where(mixed[:, None], mixed_clips, clips),
+                torch.where(mixed[:, None], mixed_targets, targets))
+
+
+@functools.lru_cache(maxsize=None)
+def psd_shape(num_samples: int, psd_shape_func: Callable) -> torch.Tensor:
+    """
+    Args:
+        num_samples: length of noise Tensor to generate
+        psd_shape_func: function that gives the shape of the noise's
+        power spectrum distribution
 
+    Returns: normalized frequency amplitudes of the noise
+    Cached because it only depends on the noise type and length
+    """
+    # Adjust frequency amplitudes according to
+    # function determining the psd shape
+    shape_signal = psd_shape_func(torch.fft.rfftfreq(num_samples))
+    # Normalize signal
+    return shape_signal / torch.sqrt(torch.mean(shape_signal.float()**2))
 
 def gen_noise(num_samples: int, psd_shape_func: Callable) -> torch.Tensor:
     """
@@ -154,19 +148,13 @@ def gen_noise(num_samples: int, psd_shape_func: Callable) -> torch.Tensor:
         num_samples: length of noise Tensor to generate
         psd_shape_func: function that gives the shape of the noise's
         power spectrum distribution
-        device: CUDA or CPU for processing
 
     Returns: noise Tensor of length num_samples
     """
     #Reverse fourier transfrom of random array to get white noise
     white_signal = torch.fft.rfft(torch.rand(num_samples))
-    # Adjust frequency amplitudes according to
-    # function determining the psd shape
-    shape_signal = psd_shape_func(torch.fft.rfftfreq(num_samples))
-    # Normalize signal
-    shape_signal = shape_signal / torch.sqrt(torch.mean(shape_signal.float()**2))
     # Adjust frequency amplitudes according to noise type
-    noise = white_signal * shape_signal
+    noise = white_signal * psd_shape(num_samples, psd_shape_func)
     return torch.fft.irfft(noise)
 
 def noise_generator(func: Callable):
@@ -216,7 +204,6 @@ class SyntheticNoise(torch.nn.Module):
         super().__init__()
         self.noise_type = cfg.noise_type
         self.alpha = cfg.noise_alpha
-        self.device = cfg.prepros_device
 
     def forward(self, clip: torch.Tensor)->torch.Tensor:
         """
@@ -226,7 +213,7 @@ class SyntheticNoise(torch.nn.Module):
         Returns: Clip mixed with noise according to noise_type and alpha
         """
         noise_function = self.noise_names[self.noise_type]
-        noise = noise_function(len(clip)).to(self.device)
+        noise = noise_function(len(clip)).to(clip.device)
         return (1 - self.alpha) * clip + self.alpha* noise
 
 
@@ -266,6 +253,13 @@ class RandomEQ(torch.nn.Module):
                 clip, self.sample_rate, frequency, gain, q_val)
         return clip
 
+def random_window(waveform: Any, clip_len: int) -> Any:
+    """
+    Returns random window of length clip_len from a Tensor or array
+    """
+    start_idx = utils.randint(0, len(waveform) - clip_len)
+    return waveform[start_idx:start_idx+clip_len]
+
 # Mald about it pylint!
 # pylint: disable-next=too-many-instance-attributes
 class BackgroundNoise(torch.nn.Module):
@@ -283,11 +277,10 @@ class BackgroundNoise(torch.nn.Module):
         self.alpha_range = cfg.bg_noise_alpha_range
         self.sample_rate = cfg.sample_rate
         self.length = cfg.chunk_length_s
-        self.device = cfg.prepros_device
         self.norm = norm
         if self.noise_path_str != "" and cfg.bg_noise_p > 0.0:
             files = list(os.listdir(self.noise_path))
-            audio_extensions = (".mp3",".wav",".ogg",".flac",".opus",".sphere",".pt")
+            audio_extensions = (".mp3",".wav",".ogg",".flac",".opus",".sphere",".pt",".npy")
             self.noise_clips = [f for f in files if f.endswith(audio_extensions)]
             if len(self.noise_clips) == 0:
                 raise RuntimeError("Background noise path specified, but no audio files found. " \
@@ -318,34 +311,57 @@ class BackgroundNoise(torch.nn.Module):
             logger.warning('Error loading noise clip, background noise augmentation not performed')
             logger.error(e)
             return clip
-        return (1 - alpha)*clip + alpha*noise_clip
+        return (1 - alpha)*clip + alpha*noise_clip.to(clip.device)
 
     def choose_random_noise(self):
         """
         Returns: Tensor of random noise, loaded from self.noise_path
+        Only the samples of the returned clip are read from disk when possible
         """
         rand_idx = utils.randint(0, len(self.noise_clips))
         noise_file = self.noise_path / self.noise_clips[rand_idx]
         clip_len = self.sample_rate * self.length
 
-        if str(noise_file).endswith(".pt"):
-            waveform = torch.load(noise_file).to(self.device, dtype=torch.float32)/32767.0
+        if noise_file.suffix == ".npy":
+            # Memory mapped, so only the clip is read from disk
+            clip = random_window(np.load(noise_file, mmap_mode="r"), clip_len)
+            waveform = torch.from_numpy(clip.astype(np.float32))/32767.0
+        elif noise_file.suffix == ".pt":
+            clip = random_window(torch.load(noise_file), clip_len)
+            waveform = clip.to(dtype=torch.float32)/32767.0
         else:
-            # pryright complains that load isn't called from torchaudio. It is.
-            waveform, sample_rate = torchaudio.load(noise_file, normalize=True) #pyright: ignore
-            waveform = waveform[0].to(self.device)
-            if sample_rate != self.sample_rate:
-                waveform = torchaudio.functional.resample(
-                        waveform, orig_freq=sample_rate, new_freq=self.sample_rate)
-                torch.save((waveform*32767).to(dtype=torch.int16), noise_file.with_suffix(".pt"))
-                os.remove(noise_file)
-                file_name = self.noise_clips[rand_idx]
-                self.noise_clips.remove(file_name)
-                self.noise_clips.append(str(Path(file_name).with_suffix(".pt").name))
+            waveform = self.load_audio_noise(rand_idx, clip_len)
         if self.norm:
             waveform = utils.norm(waveform)
-        start_idx = utils.randint(0, len(waveform) - clip_len)
-        return waveform[start_idx:start_idx+clip_len]
+        return waveform
+
+    def load_audio_noise(self, rand_idx: int, clip_len: int) -> torch.Tensor:
+        """
+        Returns: Tensor of a random clip of the audio file noise_clips[rand_idx]
+        Audio at the target sample rate is partially read. Other audio is resampled
+        and replaced with a .npy file so it does not have to be resampled again
+        """
+        noise_file = self.noise_path / self.noise_clips[rand_idx]
+        # pryright complains that info and load aren't called from torchaudio. They are.
+        info = torchaudio.info(noise_file) #pyright: ignore
+        # Some formats do not report their length
+        if info.sample_rate == self.sample_rate and info.num_frames > clip_len:
+            start_idx = utils.randint(0, info.num_frames - clip_len)
+            waveform, _ = torchaudio.load(noise_file, #pyright: ignore
+                                          frame_offset=start_idx,
+                                          num_frames=clip_len,
+                                          normalize=True)
+            return waveform[0]
+
+        waveform, sample_rate = torchaudio.load(noise_file, normalize=True) #pyright: ignore
+        waveform = waveform[0]
+        if sample_rate != self.sample_rate:
+            waveform = utils.get_resampler(sample_rate, self.sample_rate)(waveform)
+            np.save(noise_file.with_suffix(".npy"),
+                    (waveform*32767).to(dtype=torch.int16).numpy())
+            os.remove(noise_file)
+            self.noise_clips[rand_idx] = noise_file.with_suffix(".npy").name
+        return random_window(waveform, clip_len)
 
 
 class LowpassFilter(torch.nn.Module):
@@ -405,3 +421,49 @@ class HighpassFilter(torch.nn.Module):
                                                     self.sample_rate,
                                                     self.cutoff,
                                                     self.q_val)
+
+class SpecAugment(torch.nn.Module):
+    """
+    Masks a random band of frequencies and a random span of time in each spectrogram
+    Both masks are applied in place in one pass over the batch
+    Attributes:
+        freq_mask_p: probability of masking frequencies in a spectrogram
+        time_mask_p: probability of masking time in a spectrogram
+        freq_mask_param: maximum number of frequencies masked
+        time_mask_param: maximum number of time steps masked
+    """
+    def __init__(self, cfg: config.Config):
+        super().__init__()
+        self.freq_mask_p = cfg.freq_mask_p
+        self.time_mask_p = cfg.time_mask_p
+        self.freq_mask_param = cfg.freq_mask_param
+        self.time_mask_param = cfg.time_mask_param
+
+    @staticmethod
+    def gen_mask(batch_size: int, size: int, mask_param: int, mask_p: float,
+                 device: torch.device) -> torch.Tensor:
+        """
+        Returns (batch_size, size) boolean mask of one random span per row
+        Spans are chosen like torchaudio's FrequencyMasking and TimeMasking
+        """
+        rand = torch.rand(3, batch_size, 1, device=device)
+        width = (rand[0] * mask_param).floor()
+        start = (rand[1] * (size - width)).floor()
+        # Rows that are not augmented get an empty span
+        width.masked_fill_(rand[2] >= mask_p, 0)
+        steps = torch.arange(size, device=device)
+        return (steps >= start) & (steps < start + width)
+
+    def forward(self, mels: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            mels: Tensor of spectrograms with shape (batch, frequency, time)
+
+        Returns: Same tensor with masked frequencies and time steps set to zero
+        """
+        batch_size, num_freqs, num_steps = mels.shape
+        freq_mask = self.gen_mask(batch_size, num_freqs, self.freq_mask_param,
+                                  self.freq_mask_p, mels.device)
+        time_mask = self.gen_mask(batch_size, num_steps, self.time_mask_param,
+                                  self.time_mask_p, mels.device)
+        return mels.masked_fill_(freq_mask[:, :, None] | time_mask[:, None, :], 0)
@@ -7,16 +7,21 @@
     If this module is run directly, it tests that the dataloader works
 
 """
+import copy
+import hashlib
 import logging
 import os
-from typing import List, Tuple, Optional
+import shutil
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Iterator, List, Tuple, Optional
 import ast
 
 import numpy as np
 import pandas as pd
 import torch
 import torchaudio
-from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
+from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler, default_collate
 from torchaudio import transforms as audtr
 from torchvision.transforms import RandomApply
 from tqdm import tqdm
@@ -25,12 +30,104 @@ import wandb
 from pyha_analyzer import config
 from pyha_analyzer import utils
 from pyha_analyzer.augmentations import (BackgroundNoise, LowpassFilter, Mixup, RandomEQ,
-                                         HighpassFilter, SyntheticNoise)
+                                         HighpassFilter, SpecAugment, SyntheticNoise)
 from pyha_analyzer.chunking_methods import sliding_chunks
 
 tqdm.pandas()
 logger = logging.getLogger("acoustic_multiclass_training")
 
+# Version of the cached spectrogram format, part of every cache key
+# Increase when the saved waveforms or spectrogram normalization change
+# 2: waveforms saved as int16
+MEL_CACHE_VERSION = 2
+
+def array_name(file_name: str) -> str:
+    """
+    Returns name of the .npy file the waveform of an audio file is saved to
+    """
+    exts = "." + file_name.split(".")[-1]
+    return file_name.replace(exts, ".npy")
+
+def legacy_tensor_name(file_name: str) -> str:
+    """
+    Returns name of the .pt file older versions saved the waveform of an audio file to
+    """
+    exts = "." + file_name.split(".")[-1]
+    return file_name.replace(exts, ".pt")
+
+def load_audio_file(file_name: str, data_path: str, target_sample_rate: int) -> np.ndarray:
+    """
+    Returns waveform of audio file resampled to target_sample_rate and quantized to int16
+    Loads the waveform saved by an older version instead of decoding the file if there is one
+    """
+    legacy_path = os.path.join(data_path, legacy_tensor_name(file_name))
+    if os.path.exists(legacy_path):
+        # Waveform saved by an older version, already resampled
+        audio, sample_rate = torch.load(legacy_path), target_sample_rate
+    else:
+        # old error: "load" is not a known member of module "torchaudio"
+        # Load is a known member of torchaudio:
+        # https://pytorch.org/audio/stable/tutorials/audio_io_tutorial.html#loading-audio-data
+        audio, sample_rate = torchaudio.load(   #pyright: ignore [reportGeneralTypeIssues ]
+            os.path.join(data_path, file_name)
+        )
+
+    if len(audio.shape) > 1:
+        audio = utils.to_mono(audio)
+
+    # Resample
+    if sample_rate != target_sample_rate:
+        audio = utils.get_resampler(sample_rate, target_sample_rate)(audio)
+
+    # NaN and inf samples can't be quantized and would make NaN spectrograms
+    if not torch.isfinite(audio).all():
+        raise ValueError("waveform has non-finite samples")
+
+    # Quantize to int16 to halve the size on disk
+    return (audio.clamp(-1, 1) * 32767).to(torch.int16).numpy()
+
+def process_audio_files(file_names: List[str], data_path: str, target_sample_rate: int
+        ) -> List[str]:
+    """
+    Save waveforms of audio files as int16 arrays to .npy
+    .npy files can be memory mapped, so clips are read without loading the whole file
+    Each file is saved by a writer thread while the next one is loaded and resampled
+    Returns names of the saved arrays, with "bad" for files that could not be loaded or saved
+    Defined at module level so it can be run in worker processes
+    """
+    new_names = [array_name(file_name) for file_name in file_names]
+    saves: List[Optional[Future]] = [None] * len(file_names)
+    last_save: Optional[Future] = None
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for i, file_name in enumerate(file_names):
+            try:
+                audio = load_audio_file(file_name, data_path, target_sample_rate)
+            # IO is messy, I want any file that could be problematic
+            # removed from training so it isn't stopped after hours of time
+            # Hence broad exception
+            # pylint: disable-next=W0718
+            except Exception as exc:
+                logger.debug("%s is bad %s", file_name, exc)
+                continue
+            # Wait for the previous save so at most one waveform is waiting to be written
+            if last_save is not None:
+                wait([last_save])
+            last_save = writer.submit(np.save, os.path.join(data_path, new_names[i]), audio)
+            saves[i] = last_save
+
+    for i, save in enumerate(saves):
+        if save is None:
+            new_names[i] = "bad"
+        elif save.exception() is not None:
+            logger.debug("%s is bad %s", file_names[i], save.exception())
+            new_names[i] = "bad"
+        elif legacy_tensor_name(file_names[i]) != file_names[i]:
+            # Remove the converted waveform of an older version, unless the csv lists it
+            legacy_path = os.path.join(data_path, legacy_tensor_name(file_names[i]))
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+    return new_names
+
 # pylint: disable=too-many-instance-attributes
 class PyhaDFDataset(Dataset):
     """
@@ -60,16 +157,19 @@ class PyhaDFDataset(Dataset):
         self.onehot = onehot
         self.cfg = cfg
 
+        # Without augmentations spectrograms are deterministic, so they can be cached
+        self.cache_mels = cfg.cache_mels and not train
+        self.mel_cache_dir = os.path.join(cfg.data_path, "mel_cache")
+
         # List data directory and confirm it exists
         if not os.path.exists(cfg.data_path):
             raise FileNotFoundError("Data path does not exist")
         self.data_dir = set()
-        for root, _, files in os.walk(cfg.data_path):
+        for root, dirs, files in os.walk(cfg.data_path):
+            # Skip walking the spectrogram cache
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != self.mel_cache_dir]
             self.data_dir |= {os.path.join(root,file) for file in files}
 
-        #Log bad files
-        self.bad_files = []
-
         #Preprocessing start
         self.samples[cfg.manual_id_col] = self.samples[cfg.manual_id_col].apply(
             lambda x: ast.literal_eval(x) if isinstance(x, str) and x.startswith("{") else x
@@ -82,13 +182,21 @@ class PyhaDFDataset(Dataset):
 
         self.class_dist = self.calc_class_distribution()
 
-        #Data augmentations
-        self.convert_to_mel = audtr.MelSpectrogram(
+        # Spectrogram transforms by device, copied to other devices when first used there
+        self.mel_transforms = {"cpu": torch.nn.Sequential(
+            audtr.MelSpectrogram(
                 sample_rate=self.cfg.sample_rate,
                 n_mels=cfg.n_mels,
-                n_fft=cfg.n_fft).to(cfg.prepros_device)
-        self.decibel_convert = audtr.AmplitudeToDB(stype="power").to(cfg.prepros_device)
-        self.mixup = Mixup(self.samples, self.class_to_idx, cfg)
+                n_fft=cfg.n_fft),
+            audtr.AmplitudeToDB(stype="power")).eval()}
+
+        #Data augmentations
+        if self.cache_mels:
+            if cfg.cache_regenerate and os.path.exists(self.mel_cache_dir):
+                logger.info("Clearing spectrogram cache %s", self.mel_cache_dir)
+                shutil.rmtree(self.mel_cache_dir)
+            os.makedirs(self.mel_cache_dir, exist_ok=True)
+        self.mixup = Mixup(cfg)
         audio_augs = {
                 SyntheticNoise  : cfg.noise_p,
                 RandomEQ        : cfg.rand_eq_p,
@@ -102,9 +210,7 @@ class PyhaDFDataset(Dataset):
                 *[RandomApply([aug(cfg)], p=p) for aug, p in audio_augs]
             )
 
-        self.image_augmentations = torch.nn.Sequential(
-                RandomApply([audtr.FrequencyMasking(cfg.freq_mask_param)], p=cfg.freq_mask_p),
-                RandomApply([audtr.TimeMasking(cfg.time_mask_param)],      p=cfg.time_mask_p))
+        self.image_augmentations = SpecAugment(cfg)
 
     def calc_class_distribution(self) -> torch.Tensor:
         """ Returns class distribution (number of samples per class) """
@@ -127,13 +233,12 @@ class PyhaDFDataset(Dataset):
         """
         Checks to make sure files exist that are referenced in input df
         """
-        missing_files = pd.Series(self.samples[self.cfg.file_name_col].unique()) \
-            .progress_apply(
-                lambda file: "good" if os.path.join(
-                    self.cfg.data_path,file
-                ) in self.data_dir else file
+        unique_files = self.samples[self.cfg.file_name_col].unique()
+        found = np.fromiter(
+            (os.path.join(self.cfg.data_path, file) in self.data_dir for file in unique_files),
+            dtype=bool, count=len(unique_files)
         )
-        missing_files = missing_files[missing_files != "good"].unique()
+        missing_files = unique_files[~found]
         if missing_files.shape[0] > 0:
             logger.info("ignoring %d missing files", missing_files.shape[0])
             logger.debug("Missing files are: %s", str(missing_files))
@@ -141,69 +246,41 @@ class PyhaDFDataset(Dataset):
             ~self.samples[self.cfg.file_name_col].isin(missing_files)
         ]
 
-    def process_audio_file(self, file_name: str) -> pd.Series:
-        """
-        Save waveform of audio file as a tensor and save that tensor to .pt
-        """
-        exts = "." + file_name.split(".")[-1]
-        new_name = file_name.replace(exts, ".pt")
-        if os.path.join(self.cfg.data_path, new_name) in self.data_dir:
-            #ASSUME WE HAVE ALREADY PREPROCESSED THIS CORRECTLY
-            return pd.Series({
-                "FILE NAME": file_name,
-                "files": new_name
-            }).T
-
-
-        try:
-            # old error: "load" is not a known member of module "torchaudio"
-            # Load is a known member of torchaudio:
-            # https://pytorch.org/audio/stable/tutorials/audio_io_tutorial.html#loading-audio-data
-            audio, sample_rate = torchaudio.load(       #pyright: ignore [reportGeneralTypeIssues ]
-                os.path.join(self.cfg.data_path, file_name)
-            )
-
-            if len(audio.shape) > 1:
-                audio = utils.to_mono(audio)
-
-            # Resample
-            if sample_rate != self.cfg.sample_rate:
-                resample = audtr.Resample(sample_rate, self.cfg.sample_rate)
-                audio = resample(audio)
-
-            torch.save(audio, os.path.join(self.cfg.data_path,new_name))
-            self.data_dir.add(new_name)
-        # IO is messy, I want any file that could be problematic
-        # removed from training so it isn't stopped after hours of time
-        # Hence broad exception
-        # pylint: disable-next=W0718
-        except Exception as exc:
-            logger.debug("%s is bad %s", file_name, exc)
-            return pd.Series({
-                "FILE NAME": file_name,
-                "files": "bad"
-            }).T
-
-
-        return pd.Series({
-                "FILE NAME": file_name,
-                "files": new_name
-            }).T
-
-
     def serialize_data(self) -> None:
         """
-        For each file, check to see if the file is already a presaved tensor
-        If the files is not a presaved tensor and is an audio file, convert to tensor to make
+        For each file, check to see if the file is already a presaved array
+        If the files is not a presaved array and is an audio file, convert to array to make
         Future training faster
         """
         self.verify_audio()
         files = pd.DataFrame(self.samples[self.cfg.file_name_col].unique(),
-            columns=["files"]
+            columns=["FILE NAME"]
         )
+        files["files"] = files["FILE NAME"].apply(array_name)
 
-
-        files = files["files"].progress_apply(self.process_audio_file)
+        #ASSUME FILES WITH A SAVED ARRAY HAVE ALREADY BEEN PREPROCESSED CORRECTLY
+        unprocessed = ~files["files"].apply(
+            lambda file: os.path.join(self.cfg.data_path, file) in self.data_dir
+        )
+        if unprocessed.any():
+            logger.info("Preprocessing %d audio files", unprocessed.sum())
+            process = partial(process_audio_files,
+                              data_path=self.cfg.data_path,
+                              target_sample_rate=self.cfg.sample_rate)
+            file_names = files.loc[unprocessed, "FILE NAME"].tolist()
+            chunks = [file_names[i:i+16] for i in range(0, len(file_names), 16)]
+            new_names = []
+            # Limit each worker to one thread, since there is one worker per core
+            with ProcessPoolExecutor(initializer=torch.set_num_threads,
+                                     initargs=(1,)) as executor, \
+                    tqdm(total=len(file_names)) as progress:
+                for chunk_names in executor.map(process, chunks):
+                    new_names.extend(chunk_names)
+                    progress.update(len(chunk_names))
+            files.loc[unprocessed, "files"] = new_names
+            self.data_dir |= {
+                os.path.join(self.cfg.data_path, file) for file in new_names if file != "bad"
+            }
         logger.debug("%s", str(files.shape))
 
         num_files = files.shape[0]
@@ -224,61 +301,169 @@ class PyhaDFDataset(Dataset):
 
         self.samples["original_file_path"] = self.samples[self.cfg.file_name_col]
 
+        # Store columns as arrays, indexing these is much faster than DataFrame.iloc
+        self.file_names = self.samples[self.cfg.file_name_col].to_numpy()
+        self.offsets = self.samples[self.cfg.offset_col].to_numpy(dtype=np.float64)
+        self.durations = self.samples[self.cfg.duration_col].to_numpy(dtype=np.float64)
+        # Manual ids are either class names or dictionaries of class names to alphas
+        self.manual_ids = self.samples[self.cfg.manual_id_col].to_numpy()
+        if self.onehot:
+            self.onehot_targets = self.samples[self.classes].to_numpy(dtype=np.float32)
+        self.arrays = (self.file_names, self.offsets, self.durations, self.manual_ids)
+
     def __len__(self):
         return self.samples.shape[0]
 
-    def to_image(self, audio):
+    def __getstate__(self):
+        """ Only pickle CPU spectrogram transforms
+        Keeps dataloader workers from initializing other devices
         """
-        Convert audio clip to 3-channel spectrogram image
+        state = self.__dict__.copy()
+        state["mel_transforms"] = {"cpu": self.mel_transforms["cpu"]}
+        return state
+
+    def get_mel_transform(self, device: torch.device) -> torch.nn.Module:
+        """ Returns spectrogram transform on device """
+        device_name = str(device)
+        if device_name not in self.mel_transforms:
+            self.mel_transforms[device_name] = copy.deepcopy(self.mel_transforms["cpu"]).to(device)
+        return self.mel_transforms[device_name]
+
+    def to_mel(self, audio):
         """
-        # Mel spectrogram
-        # Pylint complains this is not callable, but it is a torch.nn.Module
-        # pylint: disable-next=not-callable
-        mel = self.convert_to_mel(audio)
-        # Convert to decibels
-        # pylint: disable-next=not-callable
-        mel = self.decibel_convert(mel)
+        Convert audio clip or batch of audio clips to normalized mel spectrogram
+        Each clip is normalized separately
+        """
+        # Mel spectrogram in decibels
+        mel = self.get_mel_transform(audio.device)(audio)
         # Convert to Image
         
         # Normalize Image (https://medium.com/@hasithsura/audio-classification-d37a82d6715)
-        mean = mel.mean()
-        std = mel.std()
-        mel = (mel - mean) / (std + 1e-6)
+        # Both moments in one reduction, then multiply by the reciprocal in place
+        std, mean = torch.std_mean(mel, dim=(-2, -1), keepdim=True)
+        mel.sub_(mean).mul_((std + 1e-6).reciprocal_())
         
         # Sigmoid to get 0 to 1 scaling (0.5 becomes mean)
-        mel = torch.sigmoid(mel)
-        return torch.stack([mel, mel, mel])
+        return mel.sigmoid_()
 
-    def __getitem__(self, index): #-> Any:
-        """ Takes an index and returns tuple of spectrogram image with corresponding label
+    @staticmethod
+    def mel_to_image(mel: torch.Tensor) -> torch.Tensor:
         """
-        assert isinstance(index, int)
-        audio, target = utils.get_annotation(
-                df = self.samples,
-                index = index,
-                class_to_idx = self.class_to_idx,
-                conf=self.cfg)
+        Repeat spectrogram or batch of spectrograms into 3 channels
+        Returns an expanded view, so the channels share memory instead of being copied
+        """
+        return mel.unsqueeze(-3).expand(*mel.shape[:-2], 3, *mel.shape[-2:])
 
-        audio, target = self.mixup(audio, target)
-        if self.train:
-            audio = self.audio_augmentations(audio)
-        image = self.to_image(audio)
-        if self.train:
-            image = self.image_augmentations(image)
+    def to_image(self, audio):
+        """
+        Convert audio clip to 3-channel spectrogram image
+        """
+        return self.mel_to_image(self.to_mel(audio))
 
-        if image.isnan().any():
-            logger.error("ERROR IN ANNOTATION #%s", index)
-            self.bad_files.append(index)
-            image = torch.zeros(image.shape)
-            target = torch.zeros(target.shape)
+    def mel_cache_file(self, index: int) -> str:
+        """
+        Returns path of the cached spectrogram of an annotation
+        Keyed on the annotation and every parameter the spectrogram depends on
+        """
+        key = "|".join(str(value) for value in (
+            MEL_CACHE_VERSION,
+            self.file_names[index],
+            self.offsets[index],
+            self.durations[index],
+            self.cfg.sample_rate,
+            self.cfg.chunk_length_s,
+            self.cfg.n_mels,
+            self.cfg.n_fft))
+        file_name = hashlib.md5(key.encode("utf-8")).hexdigest() + ".mel.pt"
+        return os.path.join(self.mel_cache_dir, file_name)
+
+    def get_cached_mel(self, index: int) -> torch.Tensor:
+        """
+        Returns spectrogram of an annotation from the cache
+        Computes and saves the spectrogram if it is not cached yet
+        """
+        path = self.mel_cache_file(index)
+        if os.path.exists(path):
+            return torch.load(path).float()
+
+        audio, _ = utils.get_annotation(
+                arrays = self.arrays,
+                index = index,
+                class_to_idx = self.class_to_idx,
+                conf = self.cfg,
+                offset = False)
+        # Save as half precision since values are between 0 and 1
+        mel = self.to_mel(audio).half().cpu()
+        # Write to a temporary file first so a cache file is never partially written
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(mel, tmp_path)
+        os.replace(tmp_path, path)
+        # Return the saved precision so later epochs load the same spectrogram
+        return mel.float()
+
+    # Nothing here needs gradients, so skip autograd tracking
+    # Returned inference tensors become normal tensors when collated
+    @torch.inference_mode()
+    def __getitem__(self, index): #-> Any:
+        """ Takes an index and returns tuple of audio clip with corresponding label
+        Returns the spectrogram instead of the audio clip if spectrograms are cached
+        Clips are converted to spectrogram images by collate_fn
+        """
+        assert isinstance(index, int)
+        if self.cache_mels:
+            clip = self.get_cached_mel(index)
+            target = utils.get_target(self.manual_ids[index], self.class_to_idx)
+        else:
+            clip, target = utils.get_annotation(
+                    arrays = self.arrays,
+                    index = index,
+                    class_to_idx = self.class_to_idx,
+                    conf=self.cfg)
+
+            if self.train:
+                clip = self.audio_augmentations(clip)
 
         #If dataframe has saved onehot encodings, return those
         #Assume columns names are species names
         if  self.onehot:
-            target = self.samples.loc[index, self.classes].values.astype(np.int32)
-            target = torch.Tensor(target)
+            target = torch.from_numpy(self.onehot_targets[index])
+
+        return clip, target
+
+    def collate_fn(self, batch: List[Tuple[torch.Tensor, torch.Tensor]]
+            ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Stacks a batch of clips
+        If prepros_device is the CPU, also converts the batch to spectrograms
+        Otherwise batches are converted in the main process by spectrogram_batches
+        """
+        clips, targets = default_collate(batch)
+        if self.train:
+            clips, targets = self.mixup(clips, targets)
+        if self.device == "cpu":
+            return self.convert_batch(clips, targets)
+        return clips, targets
+
+    def convert_batch(self, clips: torch.Tensor, targets: torch.Tensor
+            ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Converts a batch of clips to spectrograms on the device the batch is on
+        Converting the whole batch at once runs a single batched FFT instead of one per clip
+        Spectrograms are single channel, use mel_to_image to get 3-channel images
+        """
+        # Cached spectrograms are already converted
+        mels = self.to_mel(clips) if clips.dim() == 2 else clips
+        if self.train:
+            mels = self.image_augmentations(mels)
 
-        return image, target
+        # Masked fills instead of indexing, so bad images are zeroed without
+        # waiting for the device to find out whether there are any
+        bad_images = mels.isnan().flatten(start_dim=1).any(dim=1)
+        mels.masked_fill_(bad_images[:, None, None], 0)
+        targets.masked_fill_(bad_images[:, None], 0)
+        # Counting them would wait for the device, so only log on the CPU
+        if mels.device.type == "cpu" and bad_images.any():
+            logger.error("ERROR IN %d ANNOTATIONS", int(bad_images.sum()))
+
+        return mels, targets
 
     def get_num_classes(self) -> int:
         """ Returns number of classes
@@ -389,6 +574,30 @@ def get_datasets(cfg) -> Tuple[PyhaDFDataset, PyhaDFDataset, Optional[PyhaDFData
 
     return train_ds, valid_ds, infer_ds
 
+def spectrogram_batches(data_loader: DataLoader
+        ) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Yields the batches of a PyhaDFDataset dataloader as spectrograms
+    If prepros_device is the CPU, the dataloader workers already converted them.
+    Otherwise the workers only load audio, and each batch is copied to
+    prepros_device and converted there in the main process.
+    Targets are copied too, since convert_batch zeroes them with masks on prepros_device
+    """
+    dataset: PyhaDFDataset = data_loader.dataset # type: ignore
+    for clips, targets in data_loader:
+        if dataset.device != "cpu":
+            clips, targets = dataset.convert_batch(
+                clips.to(dataset.device, non_blocking=True),
+                targets.to(dataset.device, non_blocking=True))
+        yield clips, targets
+
+def use_pin_memory(cfg) -> bool:
+    """
+    Returns whether dataloaders should return batches in pinned memory
+    Pinned batches can be copied to the GPU asynchronously
+    """
+    return str(cfg.device).startswith("cuda") or cfg.prepros_device != "cpu"
+
 def set_torch_file_sharing(_) -> None:
     """
     Sets torch.multiprocessing to use file sharing
@@ -420,7 +629,11 @@ def make_dataloaders(train_dataset, val_dataset, infer_dataset, cfg
             cfg.train_batch_size,
             sampler=sampler,
             num_workers=cfg.jobs,
-            worker_init_fn=set_torch_file_sharing
+            worker_init_fn=set_torch_file_sharing,
+            collate_fn=train_dataset.collate_fn,
+            pin_memory=use_pin_memory(cfg),
+            # Keep workers and their copies of the dataset alive between epochs
+            persistent_workers=cfg.jobs > 0
         )
     else:
         train_dataloader = DataLoader(
@@ -428,7 +641,10 @@ def make_dataloaders(train_dataset, val_dataset, infer_dataset, cfg
             cfg.train_batch_size,
             shuffle=True,
             num_workers=cfg.jobs,
-            worker_init_fn=set_torch_file_sharing
+            worker_init_fn=set_torch_file_sharing,
+            collate_fn=train_dataset.collate_fn,
+            pin_memory=use_pin_memory(cfg),
+            persistent_workers=cfg.jobs > 0
         )
 
     val_dataloader = DataLoader(
@@ -436,6 +652,9 @@ def make_dataloaders(train_dataset, val_dataset, infer_dataset, cfg
         cfg.validation_batch_size,
         shuffle=False,
         num_workers=cfg.jobs,
+        collate_fn=val_dataset.collate_fn,
+        pin_memory=use_pin_memory(cfg),
+        persistent_workers=cfg.jobs > 0
     )
     if infer_dataset is None:
         infer_dataloader = None
@@ -445,7 +664,10 @@ def make_dataloaders(train_dataset, val_dataset, infer_dataset, cfg
                 cfg.validation_batch_size,
                 shuffle=False,
                 num_workers=cfg.jobs,
-                worker_init_fn=set_torch_file_sharing
+                worker_init_fn=set_torch_file_sharing,
+                collate_fn=infer_dataset.collate_fn,
+                pin_memory=use_pin_memory(cfg),
+                persistent_workers=cfg.jobs > 0
             )
     return train_dataloader, val_dataloader, infer_dataloader
 
@@ -30,6 +30,8 @@ def get_test_map():
         cfg.train_batch_size,
         shuffle=False,
         num_workers=cfg.jobs,
+        collate_fn=test_ds.collate_fn,
+        pin_memory=dataset.use_pin_memory(cfg)
     )
 
     # Get model
@@ -15,11 +15,11 @@ import wandb
 from pyha_analyzer import config
 from pyha_analyzer import utils
 from pyha_analyzer.augmentations import (BackgroundNoise, LowpassFilter, Mixup, RandomEQ,
-                                         HighpassFilter, SyntheticNoise)
+                                         HighpassFilter, SpecAugment, SyntheticNoise)
 from pyha_analyzer.chunking_methods.sliding_chunks import convolving_chunk
 from pyha_analyzer.models.early_stopper import EarlyStopper
 from pyha_analyzer.models.timm_model import TimmModel
-from pyha_analyzer.dataset import get_datasets, make_dataloaders
+from pyha_analyzer.dataset import get_datasets, make_dataloaders, spectrogram_batches
 from pyha_analyzer.train import run_batch, map_metric, save_model
 
 cfg = config.cfg
@@ -30,21 +30,21 @@ dataset, valid_ds, infer_ds = get_datasets(cfg)
 class TestAugmentations(unittest.TestCase):
     def test_augs(self):
         """ Test all augmentations and verify output is correct size """
-        audio, label = utils.get_annotation(dataset.samples, 0, dataset.class_to_idx, cfg)
+        audio, label = utils.get_annotation(dataset.arrays, 0, dataset.class_to_idx, cfg)
         TestUtils.assert_one_hot(label, dataset.num_classes)
-        label_id = (label == 1.0).nonzero()[0].item()
-        mixup_alpha = 0.25
-        cfg.mixup_alpha_range = [mixup_alpha, mixup_alpha] # type: ignore
         cfg.mixup_ceil_interval = 1. # type: ignore
-        num_clips_range = list(range(cfg.mixup_num_clips_range[0],
-                                     cfg.mixup_num_clips_range[1] + 1))
-        mixup = Mixup(dataset.samples, dataset.class_to_idx, cfg)
-        new_audio, new_label = mixup(audio, label)
+        cfg.mixup_p = 1. # type: ignore
+        batch = [utils.get_annotation(dataset.arrays, i, dataset.class_to_idx, cfg)
+                 for i in range(4)]
+        clips = torch.stack([clip for clip, _ in batch])
+        labels = torch.stack([label for _, label in batch])
+        mixup = Mixup(cfg)
+        new_clips, new_labels = mixup(clips, labels)
         # Assert mixup output
-        assert new_audio.shape == audio.shape, "Mixup should not change shape"
-        assert new_label[label_id] == 1., \
+        assert new_clips.shape == clips.shape, "Mixup should not change shape"
+        assert (new_labels[labels == 1.] == 1.).all(), \
                 "Mixup labels should be rounded up to nearest interval"
-        assert float(new_label.sum()) in num_clips_range, \
+        assert float(new_labels.sum(dim=1).max()) <= cfg.mixup_num_clips_range[1] + 1, \
                 "Mixup label sum should correspond to a possible number of clips"
 
         augs = []
@@ -60,6 +60,35 @@ class TestAugmentations(unittest.TestCase):
         for aug_audio in augmented_audio:
             assert aug_audio.shape == audio.shape, "Augmented audio should not change shape"
 
+    def test_spec_augment(self):
+        """ Test SpecAugment masks one frequency band and one time span per spectrogram """
+        cfg.freq_mask_p = 1. # type: ignore
+        cfg.time_mask_p = 1. # type: ignore
+        spec_augment = SpecAugment(cfg)
+        mels = torch.rand(8, cfg.freq_mask_param * 3, cfg.time_mask_param * 3) + 1
+        masked = spec_augment(mels)
+        assert masked.shape == mels.shape, "SpecAugment should not change shape"
+        assert masked.data_ptr() == mels.data_ptr(), "SpecAugment should mask in place"
+        for mel in masked:
+            zeros = mel == 0
+            freqs = zeros.all(dim=1).nonzero().flatten()
+            steps = zeros.all(dim=0).nonzero().flatten()
+            for span, mask_param in [(freqs, cfg.freq_mask_param), (steps, cfg.time_mask_param)]:
+                assert len(span) < mask_param, "Masks should be narrower than the mask param"
+                if len(span) > 0:
+                    assert span[-1] - span[0] + 1 == len(span), "Masks should be contiguous"
+            expected = torch.zeros_like(zeros)
+            expected[freqs] = True
+            expected[:, steps] = True
+            assert (zeros == expected).all(), "Only the masked band and span should be zeroed"
+
+        cfg.freq_mask_p = 0. # type: ignore
+        cfg.time_mask_p = 0. # type: ignore
+        spec_augment = SpecAugment(cfg)
+        mels = torch.rand(8, cfg.freq_mask_param * 3, cfg.time_mask_param * 3) + 1
+        assert (spec_augment(mels.clone()) == mels).all(), \
+                "SpecAugment should not change spectrograms with zero probability"
+
 
 class TestConfig(unittest.TestCase):
     def test_config(self):
@@ -82,6 +111,19 @@ class TestDataset(unittest.TestCase):
         spec = dataset.to_image(torch.zeros(5*cfg.sample_rate).to(cfg.prepros_device))
         assert (spec != spec.mean().item()).sum() == 0, "Spectrogram of no audio should be constant"
 
+    def test_bad_images(self):
+        """ Test convert_batch zeroes NaN spectrograms and their targets on each device """
+        devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+        for device in devices:
+            clips = torch.zeros(2, 5*cfg.sample_rate)
+            clips[1, 0] = float("nan")
+            targets = torch.ones(2, dataset.num_classes)
+            mels, targets = dataset.convert_batch(clips.to(device), targets.to(device))
+            assert not mels[0].isnan().any(), "Good spectrograms should not be changed"
+            assert (mels[1] == 0).all(), "NaN spectrograms should be zeroed"
+            assert (targets[0] == 1).all(), "Targets of good spectrograms should not be changed"
+            assert (targets[1] == 0).all(), "Targets of NaN spectrograms should be zeroed"
+
 
 class TestModel(unittest.TestCase):
     def test_model(self):
@@ -119,11 +161,28 @@ class TestTrain(unittest.TestCase):
         train_dl, _, _ = make_dataloaders(dataset, valid_ds, infer_ds, cfg)
         model = TimmModel(dataset.num_classes, "tf_efficientnet_b4", True).to(cfg.device)
         model.create_loss_fn(dataset)
-        mels, labels = next(iter(train_dl))
+        mels, labels = next(spectrogram_batches(train_dl))
         loss, outputs = run_batch(model, mels, labels)
         assert loss >= 0, "Loss should be positive"
         assert outputs.shape == labels.shape, "Model output shape should match labels shape"
 
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA is not available")
+    def test_device_spectrogram_batch(self):
+        """ Tests batches converted to spectrograms in the main process on prepros_device """
+        cfg.jobs = 0 # type: ignore
+        prepros_device = dataset.device
+        dataset.device = "cuda"
+        try:
+            train_dl, _, _ = make_dataloaders(dataset, valid_ds, infer_ds, cfg)
+            mels, labels = next(spectrogram_batches(train_dl))
+        finally:
+            dataset.device = prepros_device
+        assert mels.device.type == "cuda", "Spectrograms should be on prepros_device"
+        assert labels.device == mels.device, "Labels should be on the same device as spectrograms"
+        assert mels.shape[:2] == (cfg.train_batch_size, cfg.n_mels), \
+                "Spectrograms should be single channel mel spectrograms"
+        assert labels.shape == (cfg.train_batch_size, dataset.num_classes)
+
     def test_map(self):
         """ Tests if macro average precision meets expected values """
         cmap, smap = map_metric(
@@ -193,7 +252,7 @@ class TestUtils(unittest.TestCase):
         """ Tests get_annotation 100 times """
         num_samples = 5 * cfg.sample_rate
         for i in range(20):
-            audio, label = utils.get_annotation(dataset.samples, i, dataset.class_to_idx, cfg)
+            audio, label = utils.get_annotation(dataset.arrays, i, dataset.class_to_idx, cfg)
             assert audio.shape[0] == num_samples, "audio should be num_samples long"
             self.assert_one_hot(label,dataset.num_classes)
             assert str(audio.device) == "cpu", "get annotation returned wrong device"
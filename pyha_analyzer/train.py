@@ -21,7 +21,8 @@ from tqdm import tqdm
 import wandb
 
 from pyha_analyzer import config
-from pyha_analyzer.dataset import get_datasets, make_dataloaders, PyhaDFDataset
+from pyha_analyzer.dataset import (get_datasets, make_dataloaders, PyhaDFDataset,
+                                   spectrogram_batches)
 from pyha_analyzer.utils import set_seed
 from pyha_analyzer.models.early_stopper import EarlyStopper
 from pyha_analyzer.models.timm_model import TimmModel
@@ -38,14 +39,16 @@ def run_batch(model: TimmModel,
     """ Runs the model on a single batch 
         Args:
             model: the model to pass the batch through
-            mels: single batch of input data
+            mels: single batch of single channel spectrograms
             labels: single batch of expecte output
         Returns (tuple of):
             loss: the loss of the batch
             outputs: the output of the model
     """
-    mels = mels.to(cfg.device)
-    labels = labels.to(cfg.device)
+    # Batches are pinned by the dataloader, so these copies are asynchronous
+    # Spectrograms are only expanded to 3 channels after the copy
+    mels = PyhaDFDataset.mel_to_image(mels.to(cfg.device, non_blocking=True))
+    labels = labels.to(cfg.device, non_blocking=True)
     if cfg.device == "cpu": 
         dtype = torch.bfloat16
     else: 
@@ -100,7 +103,7 @@ def train(model: TimmModel,
     log_pred = []
     log_labels = []
 
-    for i, (mels, labels) in enumerate(data_loader):
+    for i, (mels, labels) in enumerate(spectrogram_batches(data_loader)):
 
         optimizer.zero_grad()
 
@@ -201,7 +204,7 @@ def valid(model: Any,
     num_valid_samples = int(len(data_loader)*dataset_ratio)
 
     # tqdm is a progress bar
-    dl_iter = tqdm(data_loader, position=5, total=num_valid_samples)
+    dl_iter = tqdm(spectrogram_batches(data_loader), position=5, total=num_valid_samples)
 
     with torch.no_grad():
         for index, (mels, labels) in enumerate(dl_iter):
@@ -263,7 +266,7 @@ def inference_valid(model: Any,
     num_valid_samples = int(len(data_loader))
 
     # tqdm is a progress bar
-    dl_iter = tqdm(data_loader, position=5, total=num_valid_samples)
+    dl_iter = tqdm(spectrogram_batches(data_loader), position=5, total=num_valid_samples)
 
     with torch.no_grad():
         for _, (mels, labels) in enumerate(dl_iter):
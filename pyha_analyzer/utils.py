@@ -2,12 +2,13 @@
 
 from pathlib import Path
 from typing import Any, Dict, Tuple
+import functools
 import math
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn.functional as F
+from torchaudio import transforms as audtr
 
 from pyha_analyzer import config
 
@@ -74,6 +75,13 @@ def to_mono(audio: torch.Tensor) -> torch.Tensor:
     """
     return torch.mean(audio, dim=0)
 
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_freq: int, new_freq: int) -> audtr.Resample:
+    """ Returns Resample transform between two sample rates
+    Cached because each transform computes its own resampling kernel
+    """
+    return audtr.Resample(orig_freq, new_freq)
+
 def one_hot(tensor, num_classes, on_value=1., off_value=0.):
     """Return one hot tensor of length num_classes
     """
@@ -89,49 +97,72 @@ def rand_offset():
         return 0
     return randint(-max_offset, max_offset)
 
+@functools.lru_cache(maxsize=None)
+def identity(num_classes: int) -> torch.Tensor:
+    """ Returns num_classes x num_classes identity matrix
+    Each row is a one hot vector, so targets can be indexed instead of rebuilt
+    """
+    return torch.eye(num_classes, dtype=torch.float32)
+
+def get_target(class_name: Any, class_to_idx: Dict[str, Any]) -> torch.Tensor:
+    """ Returns target tensor of a manual id
+    Manual ids can be a class name or a dictionary of class names to alphas
+    """
+    num_classes = len(class_to_idx)
+
+    if isinstance(class_name, dict):
+        target = torch.zeros(num_classes)
+        for name, alpha in class_name.items():
+            target[class_to_idx[name]] = alpha
+        return target
+    # Turns target from integer to one hot tensor vector. I.E. 3 -> [0, 0, 0, 1, 0, 0, 0, 0, 0, 0]
+    # Row of the cached identity matrix, so it must not be modified in place
+    return identity(num_classes)[int(class_to_idx[class_name])]
+
+@functools.lru_cache(maxsize=128)
+def load_waveform(path: str) -> np.ndarray:
+    """ Returns memory mapped waveform saved at path
+    Cached so each worker maps a file once instead of on every clip from it
+    """
+    return np.load(path, mmap_mode="r")
+
 #pylint: disable-next = too-many-arguments
 def get_annotation(
-        df: pd.DataFrame, 
+        arrays: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
         index: int,
         class_to_idx: Dict[str, Any], 
         conf,
         offset: bool = True,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
     """ Returns tuple of audio waveform and its one-hot label
+    arrays is a tuple of file name, offset, duration and manual id arrays,
+    as stored in PyhaDFDataset.arrays
     """
     assert isinstance(index, int)
     sample_rate = conf.sample_rate
     target_num_samples = conf.sample_rate * conf.chunk_length_s
-    annotation = df.iloc[index]
-    file_name = annotation[conf.file_name_col]
-    num_classes = len(set(class_to_idx.values()))
-
-    # Turns target from integer to one hot tensor vector. I.E. 3 -> [0, 0, 0, 1, 0, 0, 0, 0, 0, 0]
-    class_name = annotation[conf.manual_id_col]
-    if isinstance(class_name, dict):
-        target = torch.zeros(num_classes)
-        for name, alpha in class_name.items():
-            target[class_to_idx[name]] = alpha
-    else:
-        target = one_hot(
-                torch.tensor(class_to_idx[class_name]),
-                num_classes)[0]
-    target = target.float()
+    file_names, offsets, durations, manual_ids = arrays
+    file_name = file_names[index]
+    target = get_target(manual_ids[index], class_to_idx)
 
     try:
         # Get necessary variables from annotation
-        annotation = df.iloc[index]
-        file_name = annotation[conf.file_name_col]
-        frame_offset = int(annotation[conf.offset_col] * sample_rate)
+        frame_offset = int(offsets[index] * sample_rate)
         if offset:
             frame_offset += rand_offset()
-        num_frames = int(annotation[conf.duration_col] * sample_rate)
+        num_frames = int(durations[index] * sample_rate)
 
         # Load audio
-        audio = torch.load(Path(cfg.data_path)/file_name)
+        # Memory mapped, so only the clip is read from disk
+        audio = load_waveform(str(Path(cfg.data_path)/file_name))
     
         if audio.shape[0] > num_frames:
             audio = audio[frame_offset:frame_offset+num_frames]
+        # Copy clip out of the memory map
+        audio = torch.from_numpy(np.array(audio))
+        # Waveforms are saved as int16
+        if audio.dtype == torch.int16:
+            audio = audio.to(torch.float32) * (1 / 32767)
 
         # Crop if too long
         if audio.shape[0] > target_num_samples:
@@ -144,6 +175,4 @@ def get_annotation(
         print(file_name, index)
         raise RuntimeError("Bad Audio") from e
 
-    audio = audio.to(conf.prepros_device)
-    target = target.to(conf.prepros_device)
     return audio, target